@@ -1,31 +1,40 @@
 """
 Automatic KAG server setup and maintenance.
+
+Third party modules are imported by the functions that need them, since importing them all
+(paramiko especially) makes every command slow to start, even --help.
 """
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import TYPE_CHECKING, Optional
 import argparse
+import io
+import json
 import logging
 import os
 import pickle
-import uuid
 import shutil
 import subprocess
 import sys
-
-import digitalocean
-import kagtcprlib.webinterface
-import paramiko
-from tenacity import after_log, retry, wait, wait_fixed, stop_after_delay, stop_after_attempt
 import tempfile
-import toml
-import yaml
+import time
 
-from one_click_kag_server.ssh_keys import create_ssh_keypair
-from one_click_kag_server.sftp import MySFTPClient
+if TYPE_CHECKING:
+    import digitalocean
+    import paramiko
+    from one_click_kag_server.sftp import MySFTPClient
 
 DEFAULT_CONFIG_PATH = Path("config.yaml")
-DEFAULT_STATE_PATH = Path("state.pkl")
+DEFAULT_STATE_PATH = Path("state.json")
+LEGACY_STATE_PATH = Path("state.pkl")  # where older versions pickled the state
 SSH_KEYS_DIR = Path("ssh_keys")
 SSH_KEY_NAME_PREFIX = "one_click_kag_server"
+SSH_WINDOW_SIZE = 4 * 1024 * 1024
+SSH_MAX_PACKET_SIZE = 256 * 1024
+REMOTE_OUTPUT_CHUNK_SIZE = 64 * 1024
 FILES_TO_UPLOAD = [
     Path("droplet_setup.sh"),
     Path("docker-compose.yaml"),
@@ -33,36 +42,128 @@ FILES_TO_UPLOAD = [
 ]
 
 
+@dataclass
 class State:
     """
     Tracks the state of the server and the setup process.
-    This class can be pickled and saved/loaded so that we have persistent state between runs.
-    If this class is updated, the state file may need to be deleted.
+    This is saved to and loaded from a JSON file so that we have persistent state between runs.
     """
-    def __init__(self):
-        self.ssh_key_name = None
-        self.ssh_key_uploaded = False
-        self.droplet = None
-        self.done_droplet_setup = False
-        self.done_kag_setup = False
+    ssh_key_name: Optional[str] = None
+    ssh_key_uploaded: bool = False
+    # Only what's needed to find the droplet again. Everything else is refreshed with droplet.load()
+    droplet_data: Optional[dict] = None
+    done_droplet_setup: bool = False
+    done_kag_setup: bool = False
+    session: Optional[SessionCtx] = field(default=None, repr=False, compare=False)  # never saved
+    _droplet: Optional[digitalocean.Droplet] = field(default=None, init=False, repr=False, compare=False)
+
+    @property
+    def droplet(self) -> Optional[digitalocean.Droplet]:
+        """
+        The droplet, rebuilt from droplet_data when it's first used.
+        Commands that only need the IP address should use ip_address, which avoids importing digitalocean.
+        """
+        if self._droplet is None and self.droplet_data:
+            import digitalocean
+            self._droplet = digitalocean.Droplet(**self.droplet_data)
+        return self._droplet
+
+    @droplet.setter
+    def droplet(self, droplet: Optional[digitalocean.Droplet]):
+        self._droplet = droplet
+        self.droplet_data = None if droplet is None else State._droplet_to_dict(droplet)
+
+    @property
+    def ip_address(self) -> Optional[str]:
+        if self._droplet is not None:
+            return self._droplet.ip_address
+        return (self.droplet_data or {}).get("ip_address")
+
+    @staticmethod
+    def _droplet_to_dict(droplet: digitalocean.Droplet) -> dict:
+        return {"id": droplet.id, "token": droplet.token, "ip_address": droplet.ip_address}
+
+    def to_dict(self) -> dict:
+        # The droplet may have been loaded since it was set, so prefer its current fields
+        droplet = State._droplet_to_dict(self._droplet) if self._droplet is not None else self.droplet_data
+        return {
+            "ssh_key_name": self.ssh_key_name,
+            "ssh_key_uploaded": self.ssh_key_uploaded,
+            "droplet": droplet,
+            "done_droplet_setup": self.done_droplet_setup,
+            "done_kag_setup": self.done_kag_setup,
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> "State":
+        return State(
+            ssh_key_name=data.get("ssh_key_name"),
+            ssh_key_uploaded=data.get("ssh_key_uploaded", False),
+            droplet_data=data.get("droplet"),
+            done_droplet_setup=data.get("done_droplet_setup", False),
+            done_kag_setup=data.get("done_kag_setup", False),
+        )
 
     def save(self, path: Path = DEFAULT_STATE_PATH):
         logging.info("Saving state to %s", path)
-        with open(path, "wb") as fh:
-            pickle.dump(self, fh)
+        # Write to a temporary file first so that an interrupted save can't corrupt the state
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        with open(tmp_path, "w") as fh:
+            json.dump(self.to_dict(), fh, indent=2)
+        os.replace(tmp_path, path)
 
     @staticmethod
     def load(path: Path = DEFAULT_STATE_PATH) -> "State":
+        save_path = path
+        if not path.exists() and path == DEFAULT_STATE_PATH and LEGACY_STATE_PATH.exists():
+            path = LEGACY_STATE_PATH
         if path.exists():
             logging.info("Loading state from %s", path)
             with open(path, "rb") as fh:
-                return pickle.load(fh)
+                data = fh.read()
+            try:
+                return State.from_dict(json.loads(data))
+            except ValueError:  # not JSON, so it should be a pickle from an older version
+                pass
+            state = State.from_legacy_pickle(data)
+            logging.info("Migrating state from %s to %s", path, save_path)
+            state.save(save_path)
+            return state
         logging.info("Creating a fresh state")
         return State()
 
+    @staticmethod
+    def from_legacy_pickle(data: bytes) -> "State":
+        """Convert a state file written by older versions, which pickled the State object."""
+        try:
+            legacy = vars(pickle.loads(data))
+        except Exception as e:
+            raise RuntimeError(f"State file is neither JSON nor a pickled state from an older version: {e}")
+        state = State(
+            ssh_key_name=legacy.get("ssh_key_name"),
+            ssh_key_uploaded=legacy.get("ssh_key_uploaded", False),
+            done_droplet_setup=legacy.get("done_droplet_setup", False),
+            done_kag_setup=legacy.get("done_kag_setup", False),
+        )
+        state.droplet = legacy.get("droplet")
+        return state
+
+
+@dataclass
+class SessionCtx:
+    """An SSH connection to the droplet, shared by every step that talks to it during one run."""
+    ssh: paramiko.SSHClient
+    sftp: MySFTPClient
+
+    def close(self):
+        self.sftp.close()
+        self.ssh.close()
+
 
 def create_droplet(config: dict, state: State):
     """Create the droplet in DigitalOcean."""
+    import digitalocean
+
     logging.info("Creating droplet...")
     if not state.ssh_key_name:
         raise RuntimeError("No ssh key configured yet")
@@ -83,28 +184,71 @@ def create_droplet(config: dict, state: State):
     state.droplet = droplet
 
 
-@retry(wait=wait_fixed(5), stop=stop_after_delay(120))
 def wait_for_droplet_to_be_active(state: State):
     """
     Block until the droplet is active and ready to be SSH'd to.
     Will time out if this takes too long.
     """
+    from tenacity import retry, stop_after_delay, wait_fixed
+
+    retry(wait=wait_fixed(5), stop=stop_after_delay(120))(_check_droplet_is_active)(state)
+
+
+def _check_droplet_is_active(state: State):
+    """A single attempt of wait_for_droplet_to_be_active."""
     logging.info("Waiting for droplet to be active...")
+    # The IP address may change while the droplet is pending, so don't reuse a connection from a previous attempt
+    close_session(state)
     droplet = state.droplet
     droplet.load()
     if droplet.status != "active":
         raise ValueError("Droplet is not active yet")
 
-    ssh = open_ssh_connection(state)
-    (_, stdout, _) = ssh.exec_command("echo hello world")
+    ctx = open_session(state)
+    (_, stdout, _) = ctx.ssh.exec_command("echo hello world")
     stdout.channel.recv_exit_status()
 
 
 def load_config_yaml(path: str) -> dict:
-    """Load the config file."""
+    """
+    Load the config file.
+    The parsed config is cached next to it and reused for as long as the file's mtime and size don't change.
+    """
+    path = Path(path)
+    st = os.stat(path)
+    version = (st.st_mtime_ns, st.st_size)
+    cache_path = path.with_suffix(path.suffix + ".cache")
+    if cache_path.exists():
+        try:
+            with open(cache_path, "rb") as fh:
+                (cached_version, config) = pickle.load(fh)
+            if cached_version == version:
+                logging.info("Loading config from %s", cache_path)
+                return config
+        except Exception:
+            logging.info("Ignoring unreadable config cache %s", cache_path)
+
+    import yaml
+    try:
+        from yaml import CSafeLoader as YamlLoader
+    except ImportError:  # PyYAML was built without libyaml
+        from yaml import SafeLoader as YamlLoader
+
     logging.info("Loading config from %s", path)
     with open(path, "r") as fh:
-        return yaml.load(fh, Loader=yaml.FullLoader)
+        config = yaml.load(fh, Loader=YamlLoader)
+
+    # Only cache configs that are valid, so that a broken config is reported on every run
+    check_config(config)
+    tmp_path = cache_path.with_suffix(cache_path.suffix + ".tmp")
+    try:
+        with open(tmp_path, "wb") as fh:
+            pickle.dump((version, config), fh)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        # The cache only saves time, so carry on without it
+        logging.warning("Could not write config cache %s: %s", cache_path, e)
+    return config
 
 
 def check_config(config: dict):
@@ -119,6 +263,9 @@ def check_config(config: dict):
 
 def configure_ssh_key(config: dict, state: State):
     """Create an SSH keypair, save it locally and upload it to DigitalOcean."""
+    import digitalocean
+    from one_click_kag_server.ssh_keys import create_ssh_keypair
+
     if not SSH_KEYS_DIR.exists():
         SSH_KEYS_DIR.mkdir()
 
@@ -142,31 +289,73 @@ def configure_ssh_key(config: dict, state: State):
 
 def get_unique_id() -> str:
     """Get a random unique identifier."""
-    return str(uuid.uuid4()).split("-")[0]
+    return os.urandom(4).hex()
 
 
 def open_ssh_connection(state: State) -> paramiko.SSHClient:
     """Create an SSHClient that can be used to run commands on the server."""
+    import paramiko
+
     key_filename = str(SSH_KEYS_DIR / state.ssh_key_name)
     ssh = paramiko.SSHClient()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    pkey = paramiko.RSAKey.from_private_key_file(key_filename)
-    ssh.connect(state.droplet.ip_address, username="root", pkey=pkey)
+    try:
+        pkey = paramiko.Ed25519Key.from_private_key_file(key_filename)
+    except paramiko.SSHException:
+        # Keys created by older versions of this program are RSA
+        pkey = paramiko.RSAKey.from_private_key_file(key_filename)
+    ssh.connect(state.ip_address, username="root", pkey=pkey)
+    transport = ssh.get_transport()
+    # Stop the connection being dropped while it sits idle between setup steps
+    transport.set_keepalive(30)
+    # Channels opened from here on (SFTP, tar streams) get a larger window, so that more
+    # data can be in flight on high latency links before waiting for the other end
+    transport.default_window_size = SSH_WINDOW_SIZE
+    transport.default_max_packet_size = SSH_MAX_PACKET_SIZE
     return ssh
 
 
-def setup_droplet(config: dict, state: State):
+def open_session(state: State) -> SessionCtx:
+    """Get the SSH session for this run, connecting on first use."""
+    from one_click_kag_server.sftp import MySFTPClient
+
+    if state.session is None:
+        ssh = open_ssh_connection(state)
+        state.session = SessionCtx(ssh=ssh, sftp=MySFTPClient.from_transport(ssh.get_transport()))
+    return state.session
+
+
+def close_session(state: State):
+    """Close the SSH session for this run, if there is one."""
+    if state.session is not None:
+        state.session.close()
+        state.session = None
+
+
+def _run_remote(ssh: paramiko.SSHClient, cmd: str) -> int:
+    """
+    Run a command on the server, copying its combined stdout and stderr to our stdout as it arrives.
+    Returns the exit status of the command.
+    """
+    channel = ssh.get_transport().open_session()
+    channel.set_combine_stderr(True)
+    channel.exec_command(cmd)
+    sys.stdout.flush()
+    for chunk in iter(lambda: channel.recv(REMOTE_OUTPUT_CHUNK_SIZE), b""):
+        sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+    return channel.recv_exit_status()
+
+
+def setup_droplet(config: dict, state: State, ctx: SessionCtx):
     """Setup the droplet ready to run KAG."""
     logging.info("Setting up droplet...")
     if not state.droplet or state.droplet.status != "active":
         raise RuntimeError("Droplet isn't active yet")
 
     # Upload the setup script and other required files
-    ssh = open_ssh_connection(state)
-    sftp = ssh.open_sftp()
-    for path in FILES_TO_UPLOAD:
-        logging.info("Uploading file %s", path)
-        sftp.put(path, path.name)
+    (ssh, sftp) = (ctx.ssh, ctx.sftp)
+    sftp.put_files_tar(FILES_TO_UPLOAD, ".")
 
     # Run the setup script
     logging.info("Making the setup script executable...")
@@ -174,13 +363,7 @@ def setup_droplet(config: dict, state: State):
     stdout.channel.recv_exit_status()
 
     logging.info("Running the setup script...")
-    (_, stdout, _) = ssh.exec_command("bash -ex droplet_setup.sh 2>&1")
-    for line in stdout:
-        print(line.rstrip())
-    status = stdout.channel.recv_exit_status()
-
-    sftp.close()
-    ssh.close()
+    status = _run_remote(ssh, "bash -ex droplet_setup.sh")
 
     if status != 0:
         raise RuntimeError("Droplet setup failed")
@@ -188,143 +371,155 @@ def setup_droplet(config: dict, state: State):
     state.done_droplet_setup = True
 
 
-def setup_kag(config: dict, state: State, restart: bool=False):
+def setup_kag(config: dict, state: State, ctx: SessionCtx, restart: bool=False):
     """
     Setup KAG, once the droplet has been properly configured.
     This can also be used to restart the KAG server.
     """
     logging.info("Setting up KAG...")
 
-    ssh = open_ssh_connection(state)
-    sftp = MySFTPClient.from_transport(ssh.get_transport())
-
-    logging.info("Uploading docker-compose.yaml...")
-    sftp.put("docker-compose.yaml", "docker-compose.yaml")
+    (ssh, sftp) = (ctx.ssh, ctx.sftp)
 
-    # Upload mods
+    # Upload mods. On a restart most of them are already on the server, so only send what changed
     logging.info("Uploading mods...")
-    sftp.mkdir("Mods", ignore_existing=True)
-    sftp.put_dir("Mods", "Mods")
+    if restart:
+        sftp.mkdir("Mods", ignore_existing=True)
+        sftp.put_dir("Mods", "Mods")
+    else:
+        sftp.put_tree_tar("Mods", "Mods")
 
     # Upload cache unless we're restarting
     if not restart and config["kag"]["cache"]:
         logging.info("Uploading cache...")
-        sftp.mkdir("Cache", ignore_existing=True)
-        sftp.put_dir("Cache", "Cache")
-
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        tmp_dir = Path(tmp_dir)
-
-        logging.info("Creating autoconfig.cfg...")
-        with open(tmp_dir / "autoconfig.cfg", "w") as fh:
-            for key, value in config["kag"]["autoconfig"].items():
-                fh.write(f"{key} = {value}\n")
-
-        logging.info("Creating mods.cfg...")
-        with open(tmp_dir / "mods.cfg", "w") as fh:
-            for mod in config["kag"]["mods"]:
-                fh.write(f"{mod}\n")
-
-        logging.info("Creating security files...")
-        tmp_security_dir = tmp_dir / "Security"
-        tmp_security_dir.mkdir()
-        shutil.copyfile(Path("Security") / "seclevs.cfg", tmp_security_dir / "seclevs.cfg")
-        shutil.copyfile(Path("Security") / "normal.cfg", tmp_security_dir / "normal.cfg")
-
-        with open(Path("Security") / "superadmin.cfg", "r") as fh:
-            superadmin_cfg = fh.read().replace("$USERS", "; ".join(config["kag"]["security"]["superadmins"]))
-        with open(tmp_security_dir / "superadmin.cfg", "w") as fh:
-            fh.write(superadmin_cfg)
-
-        with open(Path("Security") / "admin.cfg", "r") as fh:
-            admin_cfg = fh.read().replace("$USERS", "; ".join(config["kag"]["security"]["admins"]))
-        with open(tmp_security_dir / "admin.cfg", "w") as fh:
-            fh.write(admin_cfg)
-
-        logging.info("Uploading autoconfig.cfg, mods.cfg, security files...")
-        sftp.put(str(Path(tmp_dir) / "autoconfig.cfg"), "autoconfig.cfg")
-        sftp.put(str(Path(tmp_dir) / "mods.cfg"), "mods.cfg")
-        sftp.mkdir("Security", ignore_existing=True)
-        sftp.put_dir(str(tmp_security_dir), "Security")
-
-    (_, stdout, _) = ssh.exec_command("docker-compose down 2>&1")
-    for line in stdout:
-        print(line.rstrip())
-    stdout.channel.recv_exit_status()
-
-    (_, stdout, _) = ssh.exec_command("docker-compose up -d 2>&1")
-    for line in stdout:
-        print(line.rstrip())
-    status = stdout.channel.recv_exit_status()
+        sftp.put_tree_tar("Cache", "Cache")
+
+    logging.info("Creating autoconfig.cfg...")
+    autoconfig_cfg = "".join(f"{key} = {value}\n" for (key, value) in config["kag"]["autoconfig"].items())
+
+    logging.info("Creating mods.cfg...")
+    mods_cfg = "".join(f"{mod}\n" for mod in config["kag"]["mods"])
+
+    logging.info("Creating security files...")
+    superadmin_cfg = (Path("Security") / "superadmin.cfg").read_text().replace(
+        "$USERS", "; ".join(config["kag"]["security"]["superadmins"]))
+    admin_cfg = (Path("Security") / "admin.cfg").read_text().replace(
+        "$USERS", "; ".join(config["kag"]["security"]["admins"]))
+
+    logging.info("Uploading docker-compose.yaml, autoconfig.cfg, mods.cfg, security files...")
+    sftp.mkdir("Security", ignore_existing=True)
+    sftp.put_many([
+        (Path("docker-compose.yaml"), "docker-compose.yaml"),
+        (io.BytesIO(autoconfig_cfg.encode()), "autoconfig.cfg"),
+        (io.BytesIO(mods_cfg.encode()), "mods.cfg"),
+        (Path("Security") / "seclevs.cfg", "Security/seclevs.cfg"),
+        (Path("Security") / "normal.cfg", "Security/normal.cfg"),
+        (io.BytesIO(superadmin_cfg.encode()), "Security/superadmin.cfg"),
+        (io.BytesIO(admin_cfg.encode()), "Security/admin.cfg"),
+    ])
+
+    _run_remote(ssh, "docker-compose down")
+    status = _run_remote(ssh, "docker-compose up -d")
     if status != 0:
         raise RuntimeError("Failed to setup KAG")
-    ssh.close()
 
     state.done_kag_setup = True
 
 
-def follow_kag_logs(state: State):
+def follow_kag_logs(state: State, ctx: SessionCtx):
     """Show the logs from the KAG server in real-time."""
     logging.info("Showing KAG logs...")
-    ssh = open_ssh_connection(state)
-    (_, stdout, _) = ssh.exec_command("docker-compose logs -f kag 2>&1")
-    for line in stdout:
-        print(line.rstrip())
+    _run_remote(ctx.ssh, "docker-compose logs -f kag")
 
 
-@retry(wait=wait_fixed(5), stop=stop_after_attempt(3), after=after_log(logging.getLogger(), logging.INFO))
 def run_command_up(config: dict, state: State):
     """
     Create the droplet, configure it to run KAG and start the KAG server.
     There are often issues with this that are solved simply by waiting a few seconds for
     something in DigitalOcean to progress, and then trying again. So retry 3 times.
     """
-    if not state.ssh_key_uploaded:
-        configure_ssh_key(config, state)
+    from tenacity import after_log, retry, stop_after_attempt, wait_fixed
 
-    if state.droplet:
-        logging.info("Droplet already exists, will not create a new one.")
-    else:
-        create_droplet(config, state)
-        wait_for_droplet_to_be_active(state)
+    retry(wait=wait_fixed(5), stop=stop_after_attempt(3),
+          after=after_log(logging.getLogger(), logging.INFO))(_run_command_up_once)(config, state)
 
-    state.droplet.load()
-    logging.info("Droplet info: %s, ip=%s, status=%s", state.droplet, state.droplet.ip_address, state.droplet.status)
 
-    if state.done_droplet_setup:
-        logging.info("Droplet setup already done.")
-    else:
-        setup_droplet(config, state)
+def _run_command_up_once(config: dict, state: State):
+    """A single attempt of run_command_up."""
+    try:
+        if not state.ssh_key_uploaded:
+            configure_ssh_key(config, state)
 
-    if state.done_kag_setup:
-        logging.info("KAG setup already done.")
-    else:
-        setup_kag(config, state)
+        if state.droplet_data:
+            logging.info("Droplet already exists, will not create a new one.")
+        else:
+            create_droplet(config, state)
+            wait_for_droplet_to_be_active(state)
+
+        state.droplet.load()
+        logging.info("Droplet info: %s, ip=%s, status=%s", state.droplet, state.droplet.ip_address, state.droplet.status)
+
+        if state.done_droplet_setup:
+            logging.info("Droplet setup already done.")
+        else:
+            setup_droplet(config, state, open_session(state))
+
+        if state.done_kag_setup:
+            logging.info("KAG setup already done.")
+        else:
+            setup_kag(config, state, open_session(state))
+    except Exception:
+        # The connection may be what broke, so let the next attempt start with a fresh one
+        close_session(state)
+        raise
 
 
 def run_command_down(config: dict, state: State):
     """Destroy the droplet & save cache."""
 
-    ssh = open_ssh_connection(state)
-    sftp = MySFTPClient.from_transport(ssh.get_transport())
+    sftp = open_session(state).sftp
 
     if config["kag"]["cache"]:
         logging.info("Saving cache")
-        sftp.get_recursive("Cache", "Cache")
+        if Path("Cache").is_dir():
+            sftp.get_recursive("Cache", "Cache")
+        else:
+            sftp.get_tree_tar("Cache", "Cache")
+    close_session(state)
 
+    # Destroying the droplet is only a DigitalOcean API call, so archive the cache while it happens.
+    # The archive is a convenience, so failing to make it mustn't stop the state being reset afterwards.
     logging.info("Destroying droplet...")
-    state.droplet.destroy()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        destroyed = executor.submit(state.droplet.destroy)
+        try:
+            if config["kag"]["cache"] and config["kag"].get("cache_archive_dir"):
+                archive_cache(Path(config["kag"]["cache_archive_dir"]))
+        except Exception as e:
+            logging.warning("Failed to archive cache: %s", e)
+        finally:
+            destroyed.result()
+
+
+def archive_cache(archive_dir: Path):
+    """Save a timestamped copy of the local Cache directory in archive_dir."""
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    base_name = archive_dir / f"Cache-{time.strftime('%Y%m%d-%H%M%S')}"
+    logging.info("Archiving cache to %s.tar.gz", base_name)
+    shutil.make_archive(str(base_name), "gztar", root_dir="Cache")
 
 
 def exec_ssh(state: State):
     """Start an SSH session to the server. Requires ssh to be installed locally."""
     logging.info("Starting SSH session...")
-    subprocess.check_call(["ssh", "-i", str(SSH_KEYS_DIR / state.ssh_key_name), f"root@{state.droplet.ip_address}"],
+    subprocess.check_call(["ssh", "-i", str(SSH_KEYS_DIR / state.ssh_key_name), f"root@{state.ip_address}"],
                           stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr)
 
 
 def run_command_rcon(config: dict, state: State):
     """Use kagtcprlib to open a web based RCON session."""
+    import kagtcprlib.webinterface
+    import toml
+
     if config["kag"]["autoconfig"].get("sv_tcpr") != 1:
         raise RuntimeError("sv_tcpr is not set in autoconfig. Set it to 1 to use RCON.")
     if not config["kag"]["autoconfig"].get("sv_rconpassword"):
@@ -333,7 +528,7 @@ def run_command_rcon(config: dict, state: State):
     kagtcprlib_cfg = {
         "my-kag-server":
             {
-                "host": state.droplet.ip_address,
+                "host": state.ip_address,
                 "port": 50301,
                 "rcon_password": config["kag"]["autoconfig"]["sv_rconpassword"],
             }
@@ -364,16 +559,16 @@ def main():
     try:
         if args.command == "up":
             run_command_up(config, state)
-            logging.info("DONE. Server running at %s", state.droplet.ip_address)
+            logging.info("DONE. Server running at %s", state.ip_address)
         elif args.command == "down":
             run_command_down(config, state)
             state = State()
             logging.info("DONE. Droplet destroyed.")
         elif args.command == "restart-kag":
-            setup_kag(config, state, True)
+            setup_kag(config, state, open_session(state), True)
             logging.info("DONE. Restarted KAG.")
         elif args.command == "kag-logs":
-            follow_kag_logs(state)
+            follow_kag_logs(state, open_session(state))
         elif args.command == "ssh":
             exec_ssh(state)
         elif args.command == "rcon":
@@ -383,6 +578,7 @@ def main():
     except:
         raise
     finally:
+        close_session(state)
         os.chdir(cwd)  # incase we've changed directory, e.g. with the web server for the rcon command
         state.save(path=args.state_file)
 
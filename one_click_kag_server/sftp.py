@@ -1,24 +1,237 @@
 import paramiko
 import logging
 import os
+import posixpath
+import shlex
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from stat import S_ISDIR
 
+# Number of SFTP channels used in parallel for recursive transfers
+MAX_WORKERS = 8
+
+
+def _is_up_to_date(src_size, src_mtime, dst_size, dst_mtime):
+    ''' A copy is up to date if it has the same size and is no older than the source.
+        SFTP only carries whole seconds, so the mtimes are compared as ints.
+    '''
+    return src_size == dst_size and int(src_mtime) <= int(dst_mtime)
+
+
+class _ChannelPool:
+    ''' Thread pool where every worker thread gets its own SFTP channel on the
+        transport of the given client, so that requests from different threads
+        are in flight at the same time over the one SSH connection.
+    '''
+    def __init__(self, sftp, max_workers=MAX_WORKERS):
+        self._transport = sftp.get_channel().get_transport()
+        self._client_class = type(sftp)
+        self._local = threading.local()
+        self._clients = []
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _client(self):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._client_class.from_transport(self._transport)
+            self._local.client = client
+            self._clients.append(client)
+        return client
+
+    def map(self, func, jobs):
+        ''' Calls func(client, *job) for each job and returns the results in order '''
+        return list(self._executor.map(lambda job: func(self._client(), *job), jobs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._executor.shutdown()
+        for client in self._clients:
+            client.close()
+
+
 class MySFTPClient(paramiko.SFTPClient):
+    def __init__(self, sock):
+        super(MySFTPClient, self).__init__(sock)
+        # Remote directories that are known to exist, so mkdir(ignore_existing=True) can skip them
+        self._known_dirs = set()
+
     def put_dir(self, source, target):
         ''' Uploads the contents of the source directory to the target path. The
-            target directory needs to exists. All subdirectories in source are 
-            created under target.
+            target directory needs to exists. All subdirectories in source are
+            created under target. Files whose remote copy already has the same
+            size and a newer or equal mtime are skipped.
         '''
-        for item in os.listdir(source):
-            if os.path.isfile(os.path.join(source, item)):
-                logging.info("Uploading %s", item)
-                self.put(os.path.join(source, item), '%s/%s' % (target, item))
-            else:
-                self.mkdir('%s/%s' % (target, item), ignore_existing=True)
-                self.put_dir(os.path.join(source, item), '%s/%s' % (target, item))
+        (levels, files) = self._walk_local(source, target)
+        with _ChannelPool(self) as pool:
+            listings = {target: self._remember_subdirs(target, self._listdir_attr_by_name(self, target))}
+            for level in levels:
+                # The listings of the level above tell us which of these already exist. The rest
+                # don't depend on each other, so create them all at once. They start out empty.
+                missing = [path for path in level if path not in self._known_dirs]
+                pool.map(MySFTPClient._mkdir_existing, [(path,) for path in missing])
+                self._known_dirs.update(missing)
+                listings.update((path, {}) for path in missing)
+
+                existing = [path for path in level if path not in listings]
+                for (path, listing) in zip(existing, pool.map(MySFTPClient._listdir_attr_by_name,
+                                                              [(path,) for path in existing])):
+                    listings[path] = self._remember_subdirs(path, listing)
+            changed = []
+            for (src, dst, local) in files:
+                remote = listings[posixpath.dirname(dst)].get(posixpath.basename(dst))
+                if remote and _is_up_to_date(local.st_size, local.st_mtime, remote.st_size, remote.st_mtime):
+                    continue
+                changed.append((src, dst, local))
+            pool.map(MySFTPClient._put_file, changed)
+
+    def put_many(self, items):
+        ''' Uploads several files at the same time, each on its own SFTP channel.
+            items are (source, target) pairs, where source is a local path or a file object.
+        '''
+        items = list(items)
+        if not items:
+            return
+        with _ChannelPool(self, max_workers=min(len(items), MAX_WORKERS)) as pool:
+            pool.map(MySFTPClient._put_item, items)
+
+    @staticmethod
+    def _put_item(sftp, source, target):
+        logging.info("Uploading %s", target)
+        if hasattr(source, "read"):
+            sftp.putfo(source, target, confirm=False)
+        else:
+            sftp.put(str(source), target, confirm=False)
+
+    def put_tree_tar(self, source, target):
+        ''' Uploads the contents of the source directory to the target path as a
+            single tar stream, which costs one round trip rather than several per
+            file. The target directory is created if it doesn't exist.
+        '''
+        members = []
+        self._scan_tree(source, "", members)
+        self._put_tar(members, target)
+
+    def put_files_tar(self, paths, target):
+        ''' Uploads the given files into the target directory as a single tar stream '''
+        self._put_tar([(str(path), os.path.basename(path)) for path in paths], target)
+
+    @staticmethod
+    def _scan_tree(source, prefix, members):
+        ''' Collects (path, arcname) pairs for everything under source. Symlinks are
+            followed, like put_dir does, since their targets won't exist on the server.
+        '''
+        with os.scandir(source) as it:
+            for entry in it:
+                arcname = prefix + entry.name
+                members.append((entry.path, arcname))
+                if entry.is_dir():
+                    MySFTPClient._scan_tree(entry.path, arcname + "/", members)
+
+    def _put_tar(self, members, target):
+        target = shlex.quote(str(target))
+        channel = self._exec_command(f"mkdir -p {target} && tar -xf - -C {target}")
+        try:
+            with channel.makefile("wb") as stdin:
+                with tarfile.open(fileobj=stdin, mode="w|", dereference=True) as tar:
+                    for (path, arcname) in members:
+                        logging.info("Uploading %s", path)
+                        tar.add(path, arcname=arcname, recursive=False)
+            channel.shutdown_write()
+        except OSError:
+            # Writing fails once the server side has exited, so report its error if it did
+            self._check_exit_status(channel)
+            raise
+        self._check_exit_status(channel)
+
+    def get_tree_tar(self, path, dest):
+        ''' Downloads the contents of the remote path into dest as a single tar stream '''
+        dest = str(dest)
+        os.makedirs(dest, exist_ok=True)
+        channel = self._exec_command(f"tar -cf - -C {shlex.quote(str(path))} .")
+        try:
+            with channel.makefile("rb") as stdout:
+                with tarfile.open(fileobj=stdout, mode="r|") as tar:
+                    if hasattr(tarfile, "data_filter"):
+                        tar.extractall(dest, filter="data")
+                    else:  # Python versions without extraction filters
+                        tar.extractall(dest)
+        except tarfile.ReadError:
+            # An empty or broken stream usually means tar failed on the server, so report its error if it did
+            self._check_exit_status(channel)
+            raise
+        # GNU tar exits with 1 when files changed while it was reading them, e.g. because KAG is
+        # still writing to its Cache. What was read is still usable, so only warn about it.
+        self._check_exit_status(channel, warn_statuses=(1,))
+
+    def _exec_command(self, command):
+        ''' Runs a command on the server over the same transport as this client '''
+        channel = self.get_channel().get_transport().open_session()
+        channel.exec_command(command)
+        return channel
+
+    @staticmethod
+    def _check_exit_status(channel, warn_statuses=()):
+        status = channel.recv_exit_status()
+        if status == 0:
+            return
+        error = channel.makefile_stderr("rb").read().decode(errors="replace").strip()
+        if status in warn_statuses:
+            logging.warning("Remote tar exited with status %s: %s", status, error)
+        else:
+            raise IOError(f"Remote tar exited with status {status}: {error}")
+
+    @staticmethod
+    def _walk_local(source, target):
+        ''' Walks source breadth first. Returns the remote directories to create, grouped
+            by depth so that parents come before children, and (src, dst, stat) for every file.
+        '''
+        levels = []
+        files = []
+        pending = [(source, target)]
+        while pending:
+            level = []
+            next_pending = []
+            for (local_dir, remote_dir) in pending:
+                with os.scandir(local_dir) as it:
+                    for entry in it:
+                        remote_path = '%s/%s' % (remote_dir, entry.name)
+                        if entry.is_dir():
+                            level.append(remote_path)
+                            next_pending.append((entry.path, remote_path))
+                        else:
+                            files.append((entry.path, remote_path, entry.stat()))
+            if level:
+                levels.append(level)
+            pending = next_pending
+        return (levels, files)
+
+    @staticmethod
+    def _mkdir_existing(sftp, path):
+        sftp.mkdir(path, ignore_existing=True)
+
+    @staticmethod
+    def _listdir_attr_by_name(sftp, path):
+        return {attr.filename: attr for attr in sftp.listdir_attr(path)}
+
+    def _remember_subdirs(self, path, listing):
+        ''' Records the subdirectories in a listing of path as known to exist '''
+        self._known_dirs.update('%s/%s' % (path, name) for (name, attr) in listing.items() if S_ISDIR(attr.st_mode))
+        return listing
+
+    @staticmethod
+    def _put_file(sftp, src, dst, local):
+        logging.info("Uploading %s", src)
+        sftp.put(src, dst, confirm=False)
+        # Pin the remote mtime to the local one so that the next put_dir sees them as equal
+        sftp.utime(dst, (local.st_atime, local.st_mtime))
 
     def mkdir(self, path, mode=511, ignore_existing=False):
         ''' Augments mkdir by adding an option to not fail if the folder exists  '''
+        if ignore_existing and path in self._known_dirs:
+            return
         try:
             super(MySFTPClient, self).mkdir(path, mode)
         except IOError:
@@ -26,15 +239,34 @@ class MySFTPClient(paramiko.SFTPClient):
                 pass
             else:
                 raise
+        self._known_dirs.add(path)
+
     def get_recursive(self, path, dest):
-        ''' Download folder recursively '''
+        ''' Download folder recursively, skipping files that are already up to date locally '''
+        files = []
+        self._walk_remote(path, str(dest), files)
+        with _ChannelPool(self) as pool:
+            pool.map(MySFTPClient._get_file, files)
+
+    def _walk_remote(self, path, dest, files):
+        ''' Creates the local directories under dest and collects (src, dst) file pairs '''
         item_list = self.listdir_attr(path)
-        dest = str(dest)
         if not os.path.isdir(dest):
             os.makedirs(dest, exist_ok=True)
         for item in item_list:
             mode = item.st_mode
             if S_ISDIR(mode):
-                self.get_recursive(path + "/" + item.filename, dest + "/" + item.filename)
+                self._walk_remote(path + "/" + item.filename, dest + "/" + item.filename, files)
             else:
-                self.get(path + "/" + item.filename, dest + "/" + item.filename)
\ No newline at end of file
+                local_path = dest + "/" + item.filename
+                if os.path.isfile(local_path):
+                    local = os.stat(local_path)
+                    if _is_up_to_date(item.st_size, item.st_mtime, local.st_size, local.st_mtime):
+                        continue
+                files.append((path + "/" + item.filename, local_path, item))
+
+    @staticmethod
+    def _get_file(sftp, src, dst, attr):
+        logging.info("Downloading %s", src)
+        sftp.get(src, dst)
+        os.utime(dst, (attr.st_atime, attr.st_mtime))
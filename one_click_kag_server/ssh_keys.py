@@ -1,19 +1,15 @@
 from cryptography.hazmat.primitives import serialization as crypto_serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.backends import default_backend as crypto_default_backend
+from cryptography.hazmat.primitives.asymmetric import ed25519
 
 
 def create_ssh_keypair() -> tuple[bytes, bytes]:
-    """Create an SSH keypair that can be used with Paramiko for SSH access to the server."""
-    key = rsa.generate_private_key(
-        backend=crypto_default_backend(),
-        public_exponent=65537,
-        key_size=2048
-    )
+    """Create an Ed25519 SSH keypair that can be used with Paramiko for SSH access to the server."""
+    key = ed25519.Ed25519PrivateKey.generate()
 
+    # Ed25519 private keys can only be serialized in the OpenSSH format
     private_key = key.private_bytes(
         crypto_serialization.Encoding.PEM,
-        format=crypto_serialization.PrivateFormat.TraditionalOpenSSL,
+        format=crypto_serialization.PrivateFormat.OpenSSH,
         encryption_algorithm=crypto_serialization.NoEncryption()
     )
 